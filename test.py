@@ -1,6 +1,11 @@
 import unittest
 from datetime import datetime
+import hashlib
 import io
+import os
+import pickle
+import tempfile
+from unittest import mock
 from ipaddress import IPv4Address, IPv6Address
 import yaml
 import pprint
@@ -14,6 +19,10 @@ class TestZonefile(unittest.TestCase):
         self.pp = pprint.PrettyPrinter()
         self.print = self.pp.pprint
 
+    @classmethod
+    def setUpClass(cls):
+        cls._parsed = {}
+
     def test_serial_calc(self):
         now = datetime.now()
         serial = now.year * 1000000 + now.month * 10000 + now.day * 100
@@ -45,7 +54,9 @@ class TestZonefile(unittest.TestCase):
         self.assertEqual(zonefile.calc_serial(serial), serial + 1)
 
     def process(self, yaml_str: str, serial, format="unbound"):
-        parsed_input = yaml.safe_load(yaml_str)
+        if yaml_str not in self._parsed:
+            self._parsed[yaml_str] = yaml.load(yaml_str, Loader=zonefile.SafeLoader)
+        parsed_input = self._parsed[yaml_str]
         writer = io.StringIO()
         zonefile.process(parsed_input, writer, serial, format)
         writer.seek(0)
@@ -123,6 +134,9 @@ class TestZonefile(unittest.TestCase):
     def assert_mx_record(self, data, domain, name, prio):
         self.assertIn(["local-data:", f'"{domain}', "IN", "MX", str(prio), f'{name}"'], data)
 
+    def assert_srv_record(self, data, service, prio, weight, port, name):
+        self.assertIn(["local-data:", f'"{service}', "IN", "SRV", str(prio), str(weight), str(port), f'{name}"'], data)
+
     def test_minimal(self):
         yaml_str = """
         home.arpa:
@@ -232,6 +246,8 @@ class TestZonefile(unittest.TestCase):
         self.assertIsInstance(zonefile.to_ip("host"), str)
         self.assertIsInstance(zonefile.to_ip("192.168.0.1"), IPv4Address)
         self.assertIsInstance(zonefile.to_ip("fe80::"), IPv6Address)
+        self.assertEqual(zonefile.to_ip("host1.home.arpa."), "host1.home.arpa.")
+        self.assertEqual(zonefile.to_ip("1234"), "1234")
 
     def test_mx(self):
         yaml_str = """
@@ -278,6 +294,169 @@ class TestZonefile(unittest.TestCase):
         self.assert_a_record(output, "mail.home.arpa.", "192.168.0.2")
         self.assert_a_ptr_records(output, "host1.home.arpa.", "192.168.0.2")
 
+    def test_mx_ns_shared_ip_single_ptr(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver:
+            ns1.home.arpa.: 192.168.0.1
+          mx:
+            mail: [10,192.168.0.1]
+        """
+        serial = 4711
+
+        output = self.process(yaml_str, serial)
+
+        self.assertEqual(len(output), 9)
+
+        self.assert_mx_record(output, "home.arpa.", "mail.home.arpa.", 10)
+        self.assert_a_ptr_records(output, "ns1.home.arpa.", "192.168.0.1")
+        self.assert_a_record(output, "mail.home.arpa.", "192.168.0.1")
+
+    def test_host_aliases(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+          hosts:
+            mickey: [little, mouse.home.arpa., 192.168.0.10]
+        """
+        serial = 4711
+
+        output = self.process(yaml_str, serial)
+
+        self.assertEqual(len(output), 9)
+
+        self.assert_a_ptr_records(output, "mickey.home.arpa.", "192.168.0.10")
+        self.assert_a_record(output, "little.home.arpa.", "192.168.0.10")
+        self.assert_a_record(output, "mouse.home.arpa.", "192.168.0.10")
+
+    def test_zone_cache(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver:
+            ns1.home.arpa.: 192.168.0.1
+        other.arpa:
+          email: test@other.arpa
+          serial: 42
+          nameserver: ns1.home.arpa.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, "zones.cache")
+            zones = zonefile.load_zones(io.BytesIO(yaml_str.encode()), cache_file)
+            self.assertTrue(os.path.exists(cache_file))
+            with mock.patch("zonefile.parse", side_effect=AssertionError("cache not used")):
+                self.assertEqual(zonefile.load_zones(io.BytesIO(yaml_str.encode()), cache_file), zones)
+
+        zones = zonefile.with_serial(zones, 4711)
+        self.assertEqual(zones[0].serial, 4711)
+        self.assertEqual(zones[1].serial, 42)
+
+    def test_zone_cache_invalid(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+        """
+        raw = yaml_str.encode()
+        digest = hashlib.blake2b(raw).hexdigest()
+        expected = zonefile.parse(yaml.load(raw, Loader=zonefile.SafeLoader), None)
+        caches = (
+            (zonefile.CACHE_VERSION - 1, digest, expected),
+            (zonefile.CACHE_VERSION, "other", ()),
+            5,
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, "zones.cache")
+            for cache in caches:
+                with open(cache_file, "wb") as file:
+                    pickle.dump(cache, file)
+                self.assertEqual(zonefile.load_zones(io.BytesIO(raw), cache_file), expected)
+
+            with open(cache_file, "wb") as file:
+                file.write(b"not a pickle")
+            self.assertEqual(zonefile.load_zones(io.BytesIO(raw), cache_file), expected)
+            self.assertEqual(zonefile.load_cache(cache_file, digest), expected)
+
+    def test_zone_cache_unwritable(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            input_file = os.path.join(tmp, "zones.yaml")
+            output_file = os.path.join(tmp, "out.txt")
+            serial_file = os.path.join(tmp, ".serial")
+            cache_file = os.path.join(tmp, "missing", "zones.cache")
+            with open(input_file, "w", encoding="UTF-8") as file:
+                file.write(yaml_str)
+
+            argv = ["zonefile", "-i", input_file, "-o", output_file, "-s", serial_file, "-c", cache_file]
+            with mock.patch("sys.argv", argv), mock.patch("sys.stderr", io.StringIO()):
+                zonefile.main()
+
+            with open(output_file, encoding="UTF-8") as file:
+                self.assertIn("IN NS   ns1.home.arpa.", file.read())
+            self.assertGreater(zonefile.load_serial(serial_file), 0)
+            self.assertFalse(os.path.exists(cache_file))
+
+    def test_srv(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+          srv:
+            ldap.tcp: [389, ldap]
+            _sip._udp: [1, 2, 5060, sip.example.com.]
+        """
+        serial = 4711
+
+        output = self.process(yaml_str, serial)
+
+        self.assertEqual(len(output), 7)
+
+        self.assert_srv_record(output, "_ldap._tcp.home.arpa.", 5, 0, 389, "ldap.home.arpa.")
+        self.assert_srv_record(output, "_sip._udp.home.arpa.", 1, 2, 5060, "sip.example.com.")
+
+    def test_srv_exception_shape(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+          srv:
+            ldap.tcp: [ldap, 389, 10]
+        """
+
+        with self.assertRaises(TypeError):
+            self.process(yaml_str, 4711)
+
+    def test_unknown_format(self):
+        yaml_str = """
+        home.arpa:
+          email: test@home.arpa
+          nameserver: ns1.home.arpa.
+        """
+
+        with self.assertRaises(ValueError):
+            self.process(yaml_str, 4711, "bind")
+
+    def test_input_unchanged(self):
+        data = {
+            "home.arpa": {
+                "email": "test@home.arpa",
+                "nameserver": {"ns1": ["192.168.0.1", 300]},
+                "mx": {"mail": [10, "192.168.0.2", 300]},
+                "hosts": {"host1": ["192.168.0.3", 300]},
+                "srv": {"ldap.tcp": [389, "host1", 300]},
+            }
+        }
+        first = zonefile.parse(data, 4711)
+        self.assertEqual(data["home.arpa"]["mx"]["mail"], [10, "192.168.0.2", 300])
+        self.assertEqual(data["home.arpa"]["srv"]["ldap.tcp"], [389, "host1", 300])
+        self.assertEqual(zonefile.parse(data, 4711), first)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,40 +1,90 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import hashlib
+import io
+import pickle
 import sys
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import date
 from collections import abc, namedtuple, defaultdict
 from ipaddress import ip_address, IPv4Address, IPv6Address
-from typing import TextIO, Tuple, List, Dict
+from typing import BinaryIO, TextIO, Tuple, List, Dict, Set, Optional, Union
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 REFRESH = 7200
 RETRY = 3600
 EXPIRE = 1209600
 NRC_TTL = 3600
 TTL = 10800
 
+# bump whenever the pickled zone or record types change
+CACHE_VERSION = 2
+
 LOCAL_DATA = "local-data:     "
 LOCAL_ZONE = "local-zone:     "
 LOCAL_PTR = "local-data-ptr: "
 INDENT = " " * 4
+LINE_FORMAT = INDENT + '{:<15} "{:<40} {:<6} {:<7} {}"\n'
+
+IP_TYPES = (IPv4Address, IPv6Address)
+
+# SRV data shapes mapped to (prio, weight, port, host)
+SRV_HANDLERS = {
+    (int, int, int, str): lambda info: (info[0], info[1], info[2], info[3]),
+    (int, str): lambda info: (5, 0, info[0], info[1]),
+}
 
 
 Zone = namedtuple(
-    "ZONE",
+    "Zone",
     ("name", "email", "serial", "refresh", "retry", "expire", "nrc_ttl", "ttl", "a", "ptr", "ns", "mx", "srv"),
 )
-ARecord = namedtuple("ARecord", ("name", "ip", "ttl"))
 
-PtrRecord = namedtuple("PtrRecord", ("name", "ip", "ttl"))
 
-NsRecord = namedtuple("NsRecord", ("zone", "name", "ttl"))
+@dataclass(slots=True, frozen=True)
+class ARecord:
+    name: str
+    ip: Union[IPv4Address, IPv6Address]
+    ttl: Optional[int]
+    rrtype: str
 
-MxRecord = namedtuple("MxRecord", ("zone", "name", "prio", "ttl"))
 
-SrvRecord = namedtuple(
-    "SrvRecord",
-    ("name", "service", "prio", "weight", "port", "ttl"),
-)
+@dataclass(slots=True, frozen=True)
+class PtrRecord:
+    name: str
+    ip: Union[IPv4Address, IPv6Address]
+    ttl: Optional[int]
+
+
+@dataclass(slots=True, frozen=True)
+class NsRecord:
+    zone: str
+    name: str
+    ttl: Optional[int]
+
+
+@dataclass(slots=True, frozen=True)
+class MxRecord:
+    zone: str
+    name: str
+    prio: int
+    ttl: Optional[int]
+
+
+@dataclass(slots=True, frozen=True)
+class SrvRecord:
+    name: str
+    service: str
+    prio: int
+    weight: int
+    port: int
+    ttl: Optional[int]
 
 
 def to_array(obj):
@@ -44,20 +94,23 @@ def to_array(obj):
     return [obj] if obj else ()
 
 
+cached_ip_address = functools.lru_cache(maxsize=1024)(ip_address)
+
+
 def to_ip(ip_addr):
     if not isinstance(ip_addr, str):
         return ip_addr
+    # plain host names can't be addresses, skip the costly ValueError
+    if "." not in ip_addr and ":" not in ip_addr:
+        return ip_addr
     try:
-        return ip_address(ip_addr)
+        return cached_ip_address(ip_addr)
     except ValueError:
         return ip_addr
 
 
-def host_string(host, zone):
-    if host == ".":
-        return f"{zone}."
-
-    return host if host.endswith(".") else f"{host}.{zone}."
+def rrtype(ip):
+    return "A" if isinstance(ip, IPv4Address) else "AAAA"
 
 
 def init_argparse() -> argparse.ArgumentParser:
@@ -65,7 +118,12 @@ def init_argparse() -> argparse.ArgumentParser:
         prog="zonefile", usage="%(prog)s [OPTION] [FILE]...", description="Program to generate zonefiles from yaml"
     )
     parser.add_argument(
-        "-i", metavar="INPUT", default=sys.stdin, dest="input", type=argparse.FileType("r"), help="Input YAML data (default stdin)."
+        "-i",
+        metavar="INPUT",
+        default=sys.stdin.buffer,
+        dest="input",
+        type=argparse.FileType("rb"),
+        help="Input YAML data (default stdin).",
     )
     parser.add_argument(
         "-o",
@@ -82,7 +140,14 @@ def init_argparse() -> argparse.ArgumentParser:
         dest="serial",
         help="File containing serial number.",
     )
-    parser.add_argument("-f", default="unbound", dest="format", help="Output format.", choices=["unbound", "nsd"])
+    parser.add_argument(
+        "-c",
+        metavar="CACHE_FILE",
+        default=None,
+        dest="cache",
+        help="Reuse parsed zones from this file while the input is unchanged.",
+    )
+    parser.add_argument("-f", default="unbound", dest="format", help="Output format.", choices=list(FORMATTERS))
 
     return parser
 
@@ -106,58 +171,112 @@ def write_serial(serial_file: str, serial: int) -> None:
 
 
 def calc_serial(serial: int) -> int:
-    now = datetime.now()
-    return max(now.year * 1000000 + now.month * 10000 + now.day * 100, serial + 1)
+    today = date.today()
+    return max(today.year * 1000000 + today.month * 10000 + today.day * 100, serial + 1)
 
 
 def parse_zone(zone_name, zone_data, serial):
     a: Dict[str, List[ARecord]] = defaultdict(list)
+    # IPs are tracked by their packed bytes, which hash in C and keep v4/v6 apart
+    a_ips: Dict[str, Set[bytes]] = defaultdict(set)
     ptr = []
+    ptr_ips: Set[bytes] = set()
     ns = []
     mx = []
     srv = []
 
+    zone_dot = f"{zone_name}."
+    suffix = f".{zone_dot}"
+
+    def qualify(host):
+        if host == ".":
+            return zone_dot
+
+        return host if host[-1:] == "." else host + suffix
+
     def extract_info(info):
-        ttl = info.pop() if len(info) > 0 and isinstance(info[-1], int) else None
-        convert = tuple(map(to_ip, info))
-        ips = set(filter(lambda x: isinstance(x, (IPv4Address, IPv6Address)), convert))
-        aliases = set(
-            map(lambda name: host_string(name, zone_name), filter(lambda x: not isinstance(x, (IPv4Address, IPv6Address)), convert))
-        )
+        ttl = None
+        if len(info) > 0 and isinstance(info[-1], int):
+            ttl = info[-1]
+            info = info[:-1]
+        ips = set()
+        aliases = set()
+        for value in map(to_ip, info):
+            if isinstance(value, IP_TYPES):
+                ips.add(value)
+            else:
+                aliases.add(qualify(value))
         return ttl, ips, aliases
 
+    def attach_ips(name, ips, ttl, kind):
+        if len(ips) == 0:
+            return
+
+        if name in a:
+            if a_ips[name] == {ip.packed for ip in ips}:
+                return
+
+            raise ValueError(f"IPs for {kind} {name} submitted while already an A-record exists.")
+
+        records = a[name]
+        record_ips = a_ips[name]
+        for ip in ips:
+            key = ip.packed
+            records.append(ARecord(name, ip, ttl, rrtype(ip)))
+            record_ips.add(key)
+            if key not in ptr_ips:
+                ptr.append(PtrRecord(name, ip, ttl))
+                ptr_ips.add(key)
+
     addresses = zone_data.get("addresses", {})
     for host in addresses:
-        name = host_string(host, zone_name)
+        name = qualify(host)
         info = to_array(addresses[host])
         ttl, ips, aliases = extract_info(info)
+        if len(ips) == 0:
+            continue
 
+        records = a[name]
+        record_ips = a_ips[name]
         for ip in ips:
-            a[name].append(ARecord(name, ip, ttl))
+            key = ip.packed
+            ip_type = rrtype(ip)
+            records.append(ARecord(name, ip, ttl, ip_type))
+            record_ips.add(key)
             for alias in aliases:
-                a[alias].append(ARecord(host_string(alias, zone_name), ip, ttl))
+                a[alias].append(ARecord(alias, ip, ttl, ip_type))
+                a_ips[alias].add(key)
 
     hosts = zone_data.get("hosts", {})
     for host in hosts:
-        name = host_string(host, zone_name)
+        name = qualify(host)
         info = to_array(hosts[host])
         ttl, ips, aliases = extract_info(info)
+        if len(ips) == 0:
+            continue
 
+        records = a[name]
+        record_ips = a_ips[name]
         for ip in ips:
-            a[name].append(ARecord(name, ip, ttl))
+            key = ip.packed
+            ip_type = rrtype(ip)
+            records.append(ARecord(name, ip, ttl, ip_type))
+            record_ips.add(key)
             ptr.append(PtrRecord(name, ip, ttl))
+            ptr_ips.add(key)
             for alias in aliases:
-                a[alias].append(ARecord(host_string(alias, zone_name), ip, ttl))
+                a[alias].append(ARecord(alias, ip, ttl, ip_type))
+                a_ips[alias].add(key)
 
     nameserver = zone_data.get("nameserver", [])
     if isinstance(nameserver, str):
-        ns.append(NsRecord(zone_name, host_string(nameserver, zone_name), None))
+        ns.append(NsRecord(zone_name, qualify(nameserver), None))
     elif isinstance(nameserver, abc.Sequence):
         for host in nameserver:
-            ns.append(NsRecord(zone_name, host_string(host, zone_name), None))
+            ns.append(NsRecord(zone_name, qualify(host), None))
     else:
         for host in nameserver:
-            name = host_string(host, zone_name)
+            name = qualify(host)
             info = to_array(nameserver[host])
             ttl, ips, aliases = extract_info(info)
 
@@ -165,44 +284,22 @@ def parse_zone(zone_name, zone_data, serial):
                 raise ValueError("Aliases in nameserver declaration is not allowed")
 
             ns.append(NsRecord(zone_name, name, ttl))
-
-            if len(ips) > 0:
-                if name in a:
-                    if len(set(map(lambda r: r.ip, a[name])) ^ ips) == 0:
-                        continue
-
-                    raise ValueError(f"IPs for nameserver {name} submitted while already an A-record exists.")
-
-                for ip in ips:
-                    a[name].append(ARecord(name, ip, ttl))
-                    if not any(host.ip == ip for host in ptr):
-                        ptr.append(PtrRecord(name, ip, ttl))
+            attach_ips(name, ips, ttl, "nameserver")
 
     for host, data in zone_data.get("mx", {}).items():
-        name = host_string(host, zone_name)
+        name = qualify(host)
         info = to_array(data)
-        prio = info.pop(0)
+        prio = info[0] if len(info) > 0 else None
         if not isinstance(prio, int):
             raise TypeError(f"First Argument to MX is prio (Number) not {type(prio)}: {zone_name} {host} {prio}")
 
-        ttl, ips, aliases = extract_info(info)
+        ttl, ips, aliases = extract_info(info[1:])
 
         if len(aliases) > 0:
             raise ValueError("Aliases in mx declaration is not allowed")
 
         mx.append(MxRecord(zone_name, name, prio, ttl))
-
-        if len(ips) > 0:
-            if name in a:
-                if len(set(map(lambda r: r.ip, a[name])) ^ ips) == 0:
-                    continue
-
-                raise ValueError(f"IPs for mx {name} submitted while already an A-record exists.")
-
-            for ip in ips:
-                a[name].append(ARecord(name, ip, ttl))
-                if not any(host.ip == ip for host in ptr):
-                    ptr.append(PtrRecord(name, ip, ttl))
+        attach_ips(name, ips, ttl, "mx")
 
     for service, info in zone_data.get("srv", {}).items():
         name, protocol, *domain = service.split(".")
@@ -210,28 +307,17 @@ def parse_zone(zone_name, zone_data, serial):
             name = f"_{name}"
         if not protocol.startswith("_"):
             protocol = f"_{protocol}"
-        service_name = host_string(".".join([name, protocol, *domain]), zone_name)
-
-        ttl = info.pop() if len(info) > 0 and isinstance(info[-1], int) else None
-        prio = 5
-        weight = 0
-        port = -1
-        if (
-            len(info) == 4
-            and isinstance(info[0], int)
-            and isinstance(info[1], int)
-            and isinstance(info[2], int)
-            and isinstance(info[3], str)
-        ):
-            prio = info[0]
-            weight = info[1]
-            port = info[2]
-        elif len(info) == 2 and isinstance(info[0], int) and isinstance(info[1], str):
-            port = info[0]
-        else:
+        service_name = qualify(".".join([name, protocol, *domain]))
+
+        ttl = None
+        if len(info) > 0 and isinstance(info[-1], int):
+            ttl = info[-1]
+            info = info[:-1]
+        handler = SRV_HANDLERS.get(tuple(map(type, info)))
+        if handler is None:
             raise TypeError(f"Couldn't identify SRV record. It's [port, name] or [prio, weight, port, name]. Given: {info}")
-        host = info[-1]
-        srv.append(SrvRecord(host_string(host, zone_name), service_name, prio, weight, port, ttl))
+        prio, weight, port, host = handler(info)
+        srv.append(SrvRecord(qualify(host), service_name, prio, weight, port, ttl))
 
     email = zone_data["email"].replace("@", ".")
     if not email.endswith("."):
@@ -255,68 +341,107 @@ def parse_zone(zone_name, zone_data, serial):
 
 
 def parse(zones, serial):
-    return tuple(map(lambda zone: parse_zone(zone[0], zone[1], serial), zones.items()))
+    return tuple(parse_zone(name, data, serial) for name, data in zones.items())
 
 
 def unbound(writer: TextIO, zones: Tuple[Zone]):
-    def write_line(writer, cmd, left, ttl, middle, right):
-        writer.write(INDENT)
-        writer.write(str(cmd).ljust(15))
-        writer.write(' "')
-        writer.write(str(left).ljust(40))
-        writer.write(" ")
-        if ttl:
-            writer.write(str(ttl).ljust(6))
-        else:
-            writer.write(" " * 6)
-        writer.write(" ")
-        writer.write(str(middle).strip().ljust(7))
-        writer.write(" ")
-        writer.write(str(right))
-        writer.write('"\n')
-
-    writer.write("server:\n")
+    out = io.StringIO()
+    write = out.write
+
+    def write_line(cmd, left, ttl, middle, right):
+        write(LINE_FORMAT.format(cmd, left, ttl or "", middle, right))
+
+    write("server:\n")
     for zone in zones:
-        zone_name = zone.name if zone.name.endswith(".") else f"{zone.name}."
+        zone_dot = f"{zone.name}."
+        zone_name = zone.name if zone.name.endswith(".") else zone_dot
 
-        writer.write(f"\n{INDENT}{LOCAL_ZONE} {zone_name} static\n")
+        write(f"\n{INDENT}{LOCAL_ZONE} {zone_name} static\n")
         write_line(
-            writer,
             LOCAL_DATA,
-            f"{zone.name}.",
+            zone_dot,
             zone.ttl,
             "IN SOA",
             f"{zone.ns[0].name} {zone.email} {zone.serial} {zone.refresh} {zone.retry} {zone.expire} {zone.nrc_ttl}",
         )
 
         for ns in zone.ns:
-            write_line(writer, LOCAL_DATA, f"{ns.zone}.", ns.ttl, "IN NS", ns.name)
+            write_line(LOCAL_DATA, zone_dot, ns.ttl, "IN NS", ns.name)
 
         for mx in zone.mx:
-            write_line(writer, LOCAL_DATA, f"{mx.zone}.", mx.ttl, "IN MX", f"{mx.prio} {mx.name}")
+            write_line(LOCAL_DATA, zone_dot, mx.ttl, "IN MX", f"{mx.prio} {mx.name}")
 
-        for hostname in zone.a:
-            for host in zone.a[hostname]:
-                write_line(
-                    writer, LOCAL_DATA, host.name, host.ttl, f"IN {'A    ' if isinstance(host.ip, IPv4Address) else 'AAAA'}", host.ip
-                )
+        for records in zone.a.values():
+            for host in records:
+                write_line(LOCAL_DATA, host.name, host.ttl, f"IN {host.rrtype}", host.ip)
 
         for srv in zone.srv:
-            write_line(writer, LOCAL_DATA, srv.service, srv.ttl, "IN SRV", f"{srv.prio} {srv.weight} {srv.port} {srv.name}")
+            write_line(LOCAL_DATA, srv.service, srv.ttl, "IN SRV", f"{srv.prio} {srv.weight} {srv.port} {srv.name}")
 
         for ptr in zone.ptr:
-            write_line(writer, LOCAL_PTR, ptr.ip, ptr.ttl, "", ptr.name)
+            write_line(LOCAL_PTR, str(ptr.ip), ptr.ttl, "", ptr.name)
+
+    writer.write(out.getvalue())
+
+
+def nsd(writer: TextIO, zones: Tuple[Zone]):
+    """nsd output is not implemented yet."""
+
+
+FORMATTERS = {"unbound": unbound, "nsd": nsd}
+
+
+def write_zones(writer, zones, output_format):
+    try:
+        formatter = FORMATTERS[output_format]
+    except KeyError:
+        raise ValueError(f"Unknown format {output_format}") from None
+
+    formatter(writer, zones)
 
 
 def process(input_data: str, writer, serial, output_format):
     zones = parse(input_data, serial)
+    write_zones(writer, zones, output_format)
 
-    if output_format == "unbound":
-        unbound(writer, zones)
-    elif output_format == "nsd":
-        pass
-    else:
-        raise ValueError(f"Unknown format {output_format}")
+
+def load_cache(cache_file: str, digest: str):
+    try:
+        with open(cache_file, "rb") as file:
+            version, cached_digest, zones = pickle.load(file)
+    except Exception:  # missing, stale or corrupt cache files are a cache miss
+        return None
+
+    return zones if version == CACHE_VERSION and cached_digest == digest else None
+
+
+def write_cache(cache_file: str, digest: str, zones) -> None:
+    # the cache is optional, failing to write it must not stop the zone output
+    try:
+        with open(cache_file, "wb") as file:
+            pickle.dump((CACHE_VERSION, digest, zones), file)
+    except (OSError, AttributeError, TypeError, pickle.PicklingError) as err:
+        print(f"Couldn't write cache file {cache_file}: {err}", file=sys.stderr)
+
+
+def load_zones(reader: BinaryIO, cache_file: str):
+    """Parse zones without a serial, reusing the cache file if the input is unchanged."""
+    raw = reader.read()
+    digest = hashlib.blake2b(raw).hexdigest()
+    zones = load_cache(cache_file, digest)
+    if zones is None:
+        input_data = yaml.load(raw, Loader=SafeLoader)
+        if input_data is None:
+            return None
+
+        zones = parse(input_data, None)
+        write_cache(cache_file, digest, zones)
+
+    return zones
+
+
+def with_serial(zones, serial):
+    return tuple(zone._replace(serial=serial) if zone.serial is None else zone for zone in zones)
 
 
 def main() -> None:
@@ -324,12 +449,20 @@ def main() -> None:
     args = parser.parse_args()
     old_serial = load_serial(args.serial)
     new_serial = calc_serial(old_serial)
-    input_data = yaml.safe_load(args.input)
 
-    if input_data is None:
-        return
+    if args.cache:
+        zones = load_zones(args.input, args.cache)
+        if zones is None:
+            return
+
+        write_zones(args.out, with_serial(zones, new_serial), args.format)
+    else:
+        input_data = yaml.load(args.input, Loader=SafeLoader)
+
+        if input_data is None:
+            return
 
-    process(input_data, args.out, new_serial, args.format)
+        process(input_data, args.out, new_serial, args.format)
 
     write_serial(args.serial, new_serial)
 